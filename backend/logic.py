@@ -1,6 +1,8 @@
 import os
 import time
 from pyicloud import PyiCloudService
+from pyicloud.exceptions import PyiCloudFailedLoginException
+from pyicloud.services.photos import PhotoAlbum
 from tqdm import tqdm
 from pillow_heif import register_heif_opener
 from PIL import Image
@@ -10,10 +12,13 @@ from itertools import islice
 import threading
 import json
 import base64
+import random
+import uuid
 from datetime import datetime, timedelta
 from collections import defaultdict
 import time
 import traceback
+from urllib.parse import urlencode
 
 # Configuration du logging
 logging.basicConfig(level=logging.DEBUG)
@@ -27,6 +32,22 @@ if not os.path.exists(SESSIONS_DIR):
 
 SESSIONS_LOCK = threading.Lock()
 
+SYNC_JOBS_DIR = os.path.join(os.path.dirname(__file__), "sync_jobs")
+if not os.path.exists(SYNC_JOBS_DIR):
+    os.makedirs(SYNC_JOBS_DIR, exist_ok=True)
+
+SYNC_JOBS_LOCK = threading.Lock()
+
+# Synchronisation périodique
+DEFAULT_SYNC_INTERVAL = 3600  # 1 heure en secondes
+MIN_SYNC_INTERVAL = 300  # 5 minutes en secondes
+MAX_SYNC_INTERVAL = 7 * 24 * 3600  # 7 jours en secondes
+SYNC_BATCH_LIMIT = 500  # fichiers téléchargés au maximum par exécution
+MAX_SYNC_RETRIES = 3  # tentatives par asset avant abandon
+SYNC_FULL_RESCAN_INTERVAL = 7 * 24 * 3600  # parcours complet de la photothèque au plus tous les 7 jours
+SYNC_JITTER_RATIO = 0.1  # jusqu'à 10% de l'intervalle
+MAX_SYNC_JITTER = 600  # 10 minutes en secondes
+
 # Protection contre les attaques par force brute
 LOGIN_ATTEMPTS = defaultdict(list)
 MAX_ATTEMPTS = 5
@@ -52,6 +73,9 @@ def record_login_attempt(email: str):
 def session_file_path(session_id):
     return os.path.join(SESSIONS_DIR, f"{session_id}.json")
 
+def sync_job_file_path(job_id):
+    return os.path.join(SYNC_JOBS_DIR, f"{job_id}.json")
+
 class ImportSession:
     def __init__(self, email, password, destination, limit, session_id=None, status="ready", progress=0, total=None, errors=None, imported_files=None):
         self.email = email
@@ -207,6 +231,62 @@ class ImportSessionManager:
         with SESSIONS_LOCK:
             return self.sessions.get(session_id)
 
+def download_asset(asset, filename):
+    """Télécharge un asset iCloud (converti en JPG si HEIC) et retourne son chemin relatif et son contenu."""
+    ext = os.path.splitext(filename)[1].lower()
+    
+    # Récupération de la date de création
+    date_obj = None
+    if hasattr(asset, 'created') and asset.created:
+        date_obj = asset.created
+    elif hasattr(asset, 'creation_date') and asset.creation_date:
+        date_obj = asset.creation_date
+
+    # Création du chemin relatif
+    if date_obj:
+        year = str(date_obj.year)
+        month = f"{date_obj.month:02d}"
+        relative_path = f"{year}/{month}/{filename}"
+    else:
+        relative_path = filename
+
+    logger.info(f"Téléchargement du fichier: {relative_path}")
+    download = asset.download()
+    file_data = download.raw.read()
+    logger.info(f"Fichier téléchargé: {len(file_data)} octets")
+
+    # Conversion HEIC en JPG si nécessaire
+    if ext == ".heic":
+        logger.info("Conversion HEIC en JPG...")
+        image = Image.open(io.BytesIO(file_data))
+        filename_jpg = os.path.splitext(filename)[0] + ".jpg"
+        relative_path = os.path.splitext(relative_path)[0] + ".jpg"
+        output = io.BytesIO()
+        image.save(output, format="JPEG")
+        file_data = output.getvalue()
+        logger.info("Conversion terminée")
+
+    return relative_path, file_data
+
+def import_asset(session, asset, filename):
+    """Télécharge un asset iCloud et l'ajoute aux fichiers disponibles de la session."""
+    relative_path, file_data = download_asset(asset, filename)
+
+    # Génération d'un token unique pour ce fichier
+    token = base64.b64encode(os.urandom(32)).decode('utf-8')
+    session.download_tokens[token] = {
+        'data': file_data,
+        'filename': os.path.basename(relative_path),
+        'expires': datetime.now() + timedelta(hours=24)
+    }
+
+    # Ajout du fichier à la liste des téléchargements
+    session.files_to_download.append({
+        'path': relative_path,
+        'token': token,
+        'size': len(file_data)
+    })
+
 # Nouvelle fonction d'import pilotable par session
 
 def run_import_session(session_id, session_manager, batch_size=10):
@@ -263,54 +343,7 @@ def run_import_session(session_id, session_manager, batch_size=10):
             try:
                 filename = asset.filename or f"photo_{int(time.time() * 1000)}"
                 logger.info(f"Traitement du fichier: {filename}")
-                
-                ext = os.path.splitext(filename)[1].lower()
-                
-                # Récupération de la date de création
-                date_obj = None
-                if hasattr(asset, 'created') and asset.created:
-                    date_obj = asset.created
-                elif hasattr(asset, 'creation_date') and asset.creation_date:
-                    date_obj = asset.creation_date
-
-                # Création du chemin relatif
-                if date_obj:
-                    year = str(date_obj.year)
-                    month = f"{date_obj.month:02d}"
-                    relative_path = f"{year}/{month}/{filename}"
-                else:
-                    relative_path = filename
-
-                logger.info(f"Téléchargement du fichier: {relative_path}")
-                download = asset.download()
-                file_data = download.raw.read()
-                logger.info(f"Fichier téléchargé: {len(file_data)} octets")
-
-                # Conversion HEIC en JPG si nécessaire
-                if ext == ".heic":
-                    logger.info("Conversion HEIC en JPG...")
-                    image = Image.open(io.BytesIO(file_data))
-                    filename_jpg = os.path.splitext(filename)[0] + ".jpg"
-                    relative_path = os.path.splitext(relative_path)[0] + ".jpg"
-                    output = io.BytesIO()
-                    image.save(output, format="JPEG")
-                    file_data = output.getvalue()
-                    logger.info("Conversion terminée")
-
-                # Génération d'un token unique pour ce fichier
-                token = base64.b64encode(os.urandom(32)).decode('utf-8')
-                session.download_tokens[token] = {
-                    'data': file_data,
-                    'filename': os.path.basename(relative_path),
-                    'expires': datetime.now() + timedelta(hours=24)
-                }
-
-                # Ajout du fichier à la liste des téléchargements
-                session.files_to_download.append({
-                    'path': relative_path,
-                    'token': token,
-                    'size': len(file_data)
-                })
+                import_asset(session, asset, filename)
 
                 processed += 1
                 session.progress = processed
@@ -337,3 +370,431 @@ def run_import_session(session_id, session_manager, batch_size=10):
         session.errors.append(f"Erreur lors de l'importation: {str(e)}")
         session.save()
 
+# Synchronisation incrémentale planifiée par compte
+
+# Statuts pour lesquels le planificateur attend une action de l'utilisateur
+SYNC_BLOCKED_STATUSES = ("auth_required", "2fa_required", "finished")
+
+def sync_jitter(interval):
+    """Décalage aléatoire pour éviter que tous les comptes se synchronisent en même temps."""
+    return random.uniform(0, min(interval * SYNC_JITTER_RATIO, MAX_SYNC_JITTER))
+
+class SyncJob:
+    def __init__(self, job_id, email, password, destination, interval=DEFAULT_SYNC_INTERVAL, limit=None, status="scheduled", sync_token=None, library_count=None, newest_added=None, synced_asset_ids=None, failed_assets=None, synced_count=0, last_full_scan=None, last_sync=None, next_run=None, errors=None):
+        self.job_id = job_id
+        self.email = email
+        self._password = password
+        self.destination = destination
+        self.interval = interval
+        self.limit = limit  # Nombre total de fichiers à synchroniser, comme pour /start (0 ou None : pas de limite)
+        self.status = status
+        # Curseur de détection des changements : jeton de synchronisation de la photothèque,
+        # nombre d'assets et date d'ajout du plus récent déjà traité
+        self.sync_token = sync_token
+        self.library_count = library_count
+        self.newest_added = newest_added
+        self.synced_asset_ids = set(synced_asset_ids) if synced_asset_ids else set()
+        self.failed_assets = dict(failed_assets) if failed_assets else {}  # id -> nombre d'échecs
+        self.synced_count = synced_count
+        self.last_full_scan = last_full_scan
+        self.last_sync = last_sync
+        self.next_run = next_run if next_run is not None else time.time() + sync_jitter(interval)
+        self.errors = errors if errors is not None else []  # Erreurs de la dernière exécution uniquement
+        self.api = None  # Session iCloud authentifiée réutilisée d'une exécution à l'autre
+        self.running = False
+
+    @property
+    def password(self):
+        return self._password
+
+    @password.setter
+    def password(self, value):
+        self._password = value
+
+    def schedule_next(self):
+        self.next_run = time.time() + self.interval + sync_jitter(self.interval)
+
+    def retryable_failures(self):
+        return {asset_id for asset_id, count in self.failed_assets.items() if count < MAX_SYNC_RETRIES}
+
+    def limit_reached(self):
+        return bool(self.limit) and self.synced_count >= self.limit
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "email": self.email,
+            "destination": self.destination,
+            "interval": self.interval,
+            "limit": self.limit,
+            "status": self.status,
+            "sync_token": self.sync_token,
+            "library_count": self.library_count,
+            "newest_added": self.newest_added,
+            "synced_asset_ids": list(self.synced_asset_ids),
+            "failed_assets": dict(self.failed_assets),
+            "synced_count": self.synced_count,
+            "last_full_scan": self.last_full_scan,
+            "last_sync": self.last_sync,
+            "next_run": self.next_run,
+            "errors": list(self.errors),
+        }
+
+    def save(self):
+        with open(sync_job_file_path(self.job_id), "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    def delete(self):
+        path = sync_job_file_path(self.job_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def load(job_id):
+        path = sync_job_file_path(job_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        interval = data.get("interval", DEFAULT_SYNC_INTERVAL)
+        status = data.get("status", "scheduled")
+        if status != "finished":
+            # Le mot de passe n'est pas persisté : le job attend d'être replanifié via /sync/schedule
+            status = "auth_required"
+        return SyncJob(
+            job_id=data.get("job_id", job_id),
+            email=data.get("email", ""),
+            password=None,
+            destination=data["destination"],
+            interval=interval,
+            limit=data.get("limit"),
+            status=status,
+            sync_token=data.get("sync_token"),
+            library_count=data.get("library_count"),
+            newest_added=data.get("newest_added"),
+            synced_asset_ids=data.get("synced_asset_ids", []),
+            failed_assets=data.get("failed_assets", {}),
+            synced_count=data.get("synced_count", 0),
+            last_full_scan=data.get("last_full_scan"),
+            last_sync=data.get("last_sync"),
+            next_run=time.time() + sync_jitter(interval),
+            errors=["Mot de passe requis pour reprendre la synchronisation"] if status == "auth_required" else [],
+        )
+
+def connect_sync_job(job):
+    """Retourne la session iCloud du job, en réutilisant celle déjà authentifiée si possible."""
+    if job.api is not None:
+        return job.api
+    if not check_login_attempts(job.email):
+        raise RuntimeError("Trop de tentatives de connexion. Veuillez réessayer dans 5 minutes.")
+    if not job.password:
+        raise RuntimeError("Mot de passe requis pour reprendre la synchronisation")
+    try:
+        # pyicloud réutilise le jeton de session stocké : pas de nouveau 2FA si l'appareil est déjà validé
+        job.api = PyiCloudService(job.email, job.password)
+    except Exception:
+        record_login_attempt(job.email)
+        raise
+    return job.api
+
+def library_sync_token(photos):
+    """Retourne le jeton de synchronisation courant de la photothèque (une seule requête).
+
+    C'est la requête CheckIndexingState que pyicloud envoie déjà avec getCurrentSyncToken,
+    mais dont il ignore la réponse.
+    """
+    url = "%s/records/query?%s" % (photos.service_endpoint, urlencode(photos.params))
+    json_data = (
+        '{"query":{"recordType":"CheckIndexingState"},'
+        '"zoneID":{"zoneName":"PrimarySync"}}'
+    )
+    request = photos.session.post(url, data=json_data, headers={"Content-type": "text/plain"})
+    return request.json().get("syncToken")
+
+def library_album(photos):
+    """Album « All Photos » parcouru du plus récent au plus ancien ajout.
+
+    Construit directement plutôt que via photos.all, qui charge d'abord la liste des dossiers
+    et met en cache la taille de l'album.
+    """
+    return PhotoAlbum(
+        photos,
+        "All Photos",
+        "CPLAssetAndMasterByAddedDate",
+        "CPLAssetByAddedDate",
+        "DESCENDING",
+    )
+
+def save_asset(asset, filename, destination):
+    """Télécharge un asset iCloud directement dans le dossier de destination."""
+    relative_path, file_data = download_asset(asset, os.path.basename(filename))
+    path = os.path.join(destination, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(file_data)
+    # Même journal que les imports manuels, pour qu'ils ignorent les fichiers déjà synchronisés
+    with open(os.path.join(destination, "imported_files.log"), "a", encoding="utf-8") as f:
+        f.write(relative_path + "\n")
+    return relative_path
+
+def run_sync_job(job_id, scheduler):
+    job = scheduler.get_job(job_id)
+    if not job:
+        return
+    logger.info(f"[SYNC] Démarrage de la synchronisation pour {job.email} (job {job_id})")
+    try:
+        try:
+            api = connect_sync_job(job)
+        except RuntimeError as e:
+            logger.warning(f"[SYNC] {str(e)} (job {job_id})")
+            job.status = "auth_required"
+            job.errors = [str(e)]
+            return
+
+        if api.requires_2fa:
+            # On garde la session iCloud : le code sera validé via /sync/2fa, sans nouvelle demande
+            logger.info(f"[SYNC] Authentification à deux facteurs requise pour {job.email}")
+            job.status = "2fa_required"
+            job.errors = []
+            return
+
+        # Une photothèque inchangée ne coûte qu'une requête : son jeton de synchronisation est identique.
+        # (La toute première exécution d'une session en coûte une de plus, pour créer le service Photos.)
+        photos = api.photos
+        sync_token = library_sync_token(photos)
+        retries = job.retryable_failures()
+        if sync_token and sync_token == job.sync_token and not retries:
+            logger.info(f"[SYNC] Aucun changement détecté pour {job.email}")
+            job.status = "idle"
+            job.errors = []
+            job.last_sync = datetime.now().isoformat()
+            return
+
+        album = library_album(photos)
+        library_count = len(album)
+        cursor = datetime.fromisoformat(job.newest_added) if job.newest_added else None
+        full_scan = (
+            cursor is None
+            or job.last_full_scan is None
+            or time.time() - job.last_full_scan > SYNC_FULL_RESCAN_INTERVAL
+        )
+        logger.info(f"[SYNC] Changement détecté pour {job.email} ({library_count} assets, parcours {'complet' if full_scan else 'incrémental'})")
+        job.status = "running"
+
+        budget = SYNC_BATCH_LIMIT
+        if job.limit:
+            budget = min(budget, job.limit - job.synced_count)
+        newest_added = None
+        newer_count = 0
+        current_ids = set()
+        imported = 0
+        truncated = False
+        errors = []
+        # Parcours du plus récent au plus ancien : en incrémental, on s'arrête au curseur
+        # dès que les assets en échec à retenter ont été revus
+        for asset in album:
+            added = asset.added_date
+            if newest_added is None:
+                newest_added = added
+            if not full_scan and added < cursor and not retries:
+                break
+            current_ids.add(asset.id)
+            retries.discard(asset.id)
+            if cursor is None or added > cursor:
+                newer_count += 1
+            if asset.id in job.synced_asset_ids or job.failed_assets.get(asset.id, 0) >= MAX_SYNC_RETRIES:
+                continue
+            if imported >= budget:
+                # Le reste sera importé aux prochaines exécutions
+                truncated = True
+                break
+            try:
+                filename = asset.filename or f"photo_{int(time.time() * 1000)}"
+                logger.info(f"[SYNC] Nouveau fichier: {filename}")
+                save_asset(asset, filename, job.destination)
+                job.synced_asset_ids.add(asset.id)
+                job.failed_assets.pop(asset.id, None)
+                job.synced_count += 1
+                imported += 1
+            except Exception as e:
+                logger.error(f"[SYNC] Erreur lors du traitement de {filename}: {str(e)}")
+                job.failed_assets[asset.id] = job.failed_assets.get(asset.id, 0) + 1
+                errors.append(f"{filename}: {str(e)}")
+
+        if truncated:
+            # Curseur inchangé : la prochaine exécution reprend le parcours sans attendre de changement
+            job.sync_token = None
+        else:
+            # Le curseur avance même en cas d'échec : les assets en échec sont retentés via failed_assets
+            job.sync_token = sync_token
+            if newest_added is not None:
+                job.newest_added = newest_added.isoformat()
+            if full_scan:
+                # Les assets supprimés de la bibliothèque sortent du curseur
+                job.synced_asset_ids &= current_ids
+                job.failed_assets = {k: v for k, v in job.failed_assets.items() if k in current_ids}
+                job.last_full_scan = time.time()
+            elif job.library_count is not None and library_count > job.library_count + newer_count:
+                # Plus d'assets que prévu : certains ont été ajoutés avec une date antérieure au curseur.
+                # Une baisse du nombre d'assets (suppressions) ne demande rien de plus.
+                logger.info(f"[SYNC] Assets ajoutés hors curseur pour {job.email}, parcours complet au prochain passage")
+                job.sync_token = None
+                job.last_full_scan = None
+            job.library_count = library_count
+
+        if job.limit_reached():
+            job.status = "finished"
+        else:
+            job.status = "error" if errors else "idle"
+        job.errors = errors
+        job.last_sync = datetime.now().isoformat()
+        logger.info(f"[SYNC] Synchronisation terminée pour {job.email}: {imported} nouveaux fichiers")
+
+    except PyiCloudFailedLoginException as e:
+        # Mot de passe refusé : on ne réessaie pas automatiquement pour ne pas bloquer le compte Apple
+        logger.warning(f"[SYNC] Connexion refusée pour {job.email}: {str(e)}")
+        job.api = None
+        job.password = None
+        job.status = "auth_required"
+        job.errors = ["Identifiants iCloud refusés, veuillez replanifier la synchronisation"]
+    except Exception as e:
+        logger.error(f"[SYNC] Erreur globale: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        # La session iCloud a pu expirer : on se reconnectera au prochain passage
+        job.api = None
+        job.status = "error"
+        job.errors = [f"Erreur lors de la synchronisation: {str(e)}"]
+    finally:
+        with SYNC_JOBS_LOCK:
+            job.running = False
+            job.schedule_next()
+            if job_id in scheduler.jobs:
+                job.save()
+
+class SyncScheduler:
+    def __init__(self, poll_interval=30):
+        self.poll_interval = poll_interval
+        self.jobs = {}
+        self.thread = None
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self.load_all_jobs()
+
+    def load_all_jobs(self):
+        for fname in os.listdir(SYNC_JOBS_DIR):
+            if fname.endswith(".json"):
+                job_id = fname[:-5]
+                job = SyncJob.load(job_id)
+                if job:
+                    self.jobs[job_id] = job
+
+    def schedule(self, email, password, destination, interval=DEFAULT_SYNC_INTERVAL, limit=None):
+        """Planifie (ou replanifie) la synchronisation d'un compte : un seul job par email."""
+        with SYNC_JOBS_LOCK:
+            job = next((j for j in self.jobs.values() if j.email == email), None)
+            if job:
+                if job.running:
+                    raise ValueError("Synchronisation en cours pour ce compte, veuillez réessayer plus tard")
+                job.password = password
+                job.destination = destination
+                job.interval = interval
+                job.limit = limit
+                job.api = None
+                job.status = "finished" if job.limit_reached() else "scheduled"
+                job.errors = []
+                job.next_run = time.time() + sync_jitter(interval)
+            else:
+                job = SyncJob(str(uuid.uuid4()), email, password, destination, interval, limit=limit)
+                self.jobs[job.job_id] = job
+            job.save()
+        self._wake_event.set()
+        return job
+
+    def validate_2fa(self, job_id, code):
+        """Valide le code 2FA sur la session iCloud du job et relance la synchronisation.
+
+        Retourne None si le job n'existe pas, False si le code est refusé.
+        """
+        with SYNC_JOBS_LOCK:
+            job = self.jobs.get(job_id)
+            if not job:
+                return None
+            if job.running or job.status != "2fa_required" or job.api is None:
+                raise ValueError("Aucune authentification à deux facteurs en attente")
+            # Empêche une exécution ou une replanification pendant la validation
+            job.running = True
+            api = job.api
+        validated = False
+        try:
+            validated = api.validate_2fa_code(code)
+        finally:
+            with SYNC_JOBS_LOCK:
+                job.running = False
+                if validated:
+                    job.status = "scheduled"
+                    job.errors = []
+                    job.next_run = time.time()
+                    if job_id in self.jobs:
+                        job.save()
+        self._wake_event.set()
+        return validated
+
+    def unschedule(self, job_id):
+        with SYNC_JOBS_LOCK:
+            job = self.jobs.pop(job_id, None)
+            if job:
+                job.delete()
+            return job
+
+    def get_job(self, job_id):
+        with SYNC_JOBS_LOCK:
+            return self.jobs.get(job_id)
+
+    def status(self, job_id):
+        with SYNC_JOBS_LOCK:
+            job = self.jobs.get(job_id)
+            if not job:
+                return None
+            return {
+                "status": job.status,
+                "destination": job.destination,
+                "interval": job.interval,
+                "limit": job.limit,
+                "synced_count": job.synced_count,
+                "library_count": job.library_count,
+                "last_sync": job.last_sync,
+                "next_run": None if job.status in SYNC_BLOCKED_STATUSES else datetime.fromtimestamp(job.next_run).isoformat(),
+                "errors": list(job.errors),
+            }
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self._stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+
+    def _run(self):
+        logger.info("[SYNC] Planificateur de synchronisation démarré")
+        while not self._stop_event.is_set():
+            now = time.time()
+            with SYNC_JOBS_LOCK:
+                # Les jobs bloqués attendent /sync/schedule ou /sync/2fa au lieu d'être relancés
+                active = [job for job in self.jobs.values() if not job.running and job.status not in SYNC_BLOCKED_STATUSES]
+                due = [job for job in active if job.next_run <= now]
+                for job in due:
+                    job.running = True
+                pending = [job.next_run for job in active if not job.running]
+            for job in due:
+                t = threading.Thread(target=run_sync_job, args=(job.job_id, self), daemon=True)
+                t.start()
+            # On dort jusqu'au prochain job, sans dépasser poll_interval pour rester réactif
+            timeout = self.poll_interval
+            if pending:
+                timeout = max(0, min(timeout, min(pending) - time.time()))
+            self._wake_event.wait(timeout)
+            self._wake_event.clear()
@@ -1,6 +1,6 @@
 from fastapi import FastAPI, HTTPException, Response, BackgroundTasks, Request
 from pydantic import BaseModel, EmailStr, constr
-from logic import run_import_session, ImportSessionManager, ImportSession
+from logic import run_import_session, ImportSessionManager, ImportSession, SyncScheduler, MIN_SYNC_INTERVAL, MAX_SYNC_INTERVAL
 from fastapi.middleware.cors import CORSMiddleware
 from pyicloud import PyiCloudService
 from fastapi.responses import JSONResponse, StreamingResponse
@@ -38,6 +38,17 @@ app.add_middleware(
 # Initialisation du gestionnaire de sessions
 session_manager = ImportSessionManager()
 
+# Planificateur des synchronisations périodiques
+sync_scheduler = SyncScheduler()
+
+@app.on_event("startup")
+async def start_sync_scheduler():
+    sync_scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_sync_scheduler():
+    sync_scheduler.stop()
+
 # Validation des entrées
 def validate_email(email: str) -> bool:
     """Valide le format d'un email."""
@@ -128,6 +139,41 @@ class StopRequest(BaseModel):
         if not re.match(r'^[a-f0-9-]{36}$', self.session_id):
             raise ValueError("ID de session invalide")
 
+class SyncScheduleRequest(BaseModel):
+    email: str
+    password: constr(min_length=8)
+    destination_folder: str
+    interval_minutes: int = 60
+    limit: Optional[int] = None  # Nombre total de fichiers à synchroniser, comme /start (0 ou absent : pas de limite)
+
+    def validate(self):
+        if not validate_email(self.email):
+            raise ValueError("Format d'email invalide")
+        if not validate_password(self.password):
+            raise ValueError("Le mot de passe ne respecte pas les critères de sécurité Apple")
+        self.destination_folder = sanitize_path(self.destination_folder)
+        if self.interval_minutes * 60 < MIN_SYNC_INTERVAL:
+            raise ValueError(f"L'intervalle doit être d'au moins {MIN_SYNC_INTERVAL // 60} minutes")
+        if self.interval_minutes * 60 > MAX_SYNC_INTERVAL:
+            raise ValueError(f"L'intervalle ne peut pas dépasser {MAX_SYNC_INTERVAL // 86400} jours")
+        if self.limit is not None and self.limit < 0:
+            raise ValueError("La limite doit être positive")
+
+class SyncJobRequest(BaseModel):
+    job_id: str
+
+    def validate(self):
+        if not re.match(r'^[a-f0-9-]{36}$', self.job_id):
+            raise ValueError("ID de synchronisation invalide")
+
+class SyncTwoFactorRequest(BaseModel):
+    job_id: str
+    code: constr(min_length=6, max_length=6)
+
+    def validate(self):
+        if not re.match(r'^[a-f0-9-]{36}$', self.job_id):
+            raise ValueError("ID de synchronisation invalide")
+
 # Stock temporaire des sessions iCloud en mémoire (exemple simple)
 sessions = {}
 
@@ -263,6 +309,60 @@ async def download_file(session_id: str, token: str):
         logger.error(f"Erreur lors du téléchargement: {str(e)}")
         raise HTTPException(status_code=500, detail="Erreur interne du serveur")
 
+@app.post("/sync/schedule")
+async def schedule_sync(request: SyncScheduleRequest):
+    try:
+        request.validate()
+        job = sync_scheduler.schedule(
+            email=request.email,
+            password=request.password,
+            destination=request.destination_folder,
+            interval=request.interval_minutes * 60,
+            limit=request.limit
+        )
+        logger.info(f"Synchronisation planifiée pour {request.email} toutes les {request.interval_minutes} minutes")
+        return {"job_id": job.job_id, "message": "Synchronisation planifiée"}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Erreur lors de la planification de la synchronisation: {str(e)}")
+        raise HTTPException(status_code=500, detail="Erreur interne du serveur")
+
+@app.post("/sync/2fa")
+async def submit_sync_2fa(request: SyncTwoFactorRequest):
+    try:
+        request.validate()
+        validated = sync_scheduler.validate_2fa(request.job_id, request.code)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Erreur lors de la validation 2FA de la synchronisation: {str(e)}")
+        raise HTTPException(status_code=500, detail="Erreur interne du serveur")
+    if validated is None:
+        raise HTTPException(status_code=404, detail="Synchronisation non trouvée")
+    if not validated:
+        raise HTTPException(status_code=400, detail="Code 2FA invalide")
+    return {"job_id": request.job_id, "message": "Synchronisation reprise après 2FA"}
+
+@app.post("/sync/unschedule")
+async def unschedule_sync(request: SyncJobRequest):
+    try:
+        request.validate()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not sync_scheduler.unschedule(request.job_id):
+        raise HTTPException(status_code=404, detail="Synchronisation non trouvée")
+    return {"message": "Synchronisation annulée"}
+
+@app.get("/sync/status/{job_id}")
+async def get_sync_status(job_id: str):
+    if not re.match(r'^[a-f0-9-]{36}$', job_id):
+        raise HTTPException(status_code=400, detail="ID de synchronisation invalide")
+    status = sync_scheduler.status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Synchronisation non trouvée")
+    return status
+
 def zipfile_streaming_generator(session):
     z = zipstream.ZipFile(mode='w', compression=zipstream.ZIP_DEFLATED)
     for file in session.files_to_download:
@@ -0,0 +1,347 @@
+"""Tests de la synchronisation planifiée.
+
+Ils utilisent le vrai PhotosService/PhotoAlbum de pyicloud 0.10.2 (Python 3.9, voir runtime.txt)
+derrière une fausse session HTTP qui compte les requêtes envoyées à iCloud.
+"""
+import base64
+import json
+import os
+import sys
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+pytest.importorskip("pyicloud", reason="pyicloud 0.10.2 requiert Python 3.9 (runtime.txt)")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logic
+from pyicloud.exceptions import PyiCloudFailedLoginException
+from pyicloud.services.photos import PhotosService
+
+
+class FakeResponse:
+    def __init__(self, payload=None, content=b""):
+        self._payload = payload
+        self.raw = self
+        self._content = content
+
+    def json(self):
+        return self._payload
+
+    def read(self):
+        return self._content
+
+
+class FakeLibrary:
+    """Photothèque iCloud simulée, triée par date d'ajout croissante comme les rangs CloudKit."""
+
+    def __init__(self, count):
+        self.assets = []
+        self.version = 0
+        self.next_id = 0
+        self.broken = set()
+        for _ in range(count):
+            self.add()
+
+    def add(self):
+        self.next_id += 1
+        self.version += 1
+        self.assets.append({
+            "id": f"asset-{self.next_id}",
+            "filename": f"IMG_{self.next_id:04d}.JPG",
+            "added": 1767225600000 + self.next_id * 60000,
+        })
+
+    def delete(self, index=0):
+        self.version += 1
+        self.assets.pop(index)
+
+
+class FakeSession:
+    def __init__(self, library):
+        self.library = library
+        self.posts = []
+
+    def post(self, url, data=None, headers=None):
+        body = json.loads(data)
+        if "/internal/records/query/batch" in url:
+            self.posts.append("HyperionIndexCountLookup")
+            count = len(self.library.assets)
+            return FakeResponse({"batch": [{"records": [{"fields": {"itemCount": {"value": count}}}]}]})
+        record_type = body["query"]["recordType"]
+        self.posts.append(record_type)
+        if record_type == "CheckIndexingState":
+            assert parse_qs(urlparse(url).query)["getCurrentSyncToken"] == ["True"]
+            return FakeResponse({
+                "records": [{"fields": {"state": {"value": "FINISHED"}}}],
+                "syncToken": f"token-{self.library.version}",
+            })
+        if record_type == "CPLAlbumByPositionLive":
+            return FakeResponse({"records": []})
+        return FakeResponse({"records": self._page(body)})
+
+    def _page(self, body):
+        filters = {f["fieldName"]: f["fieldValue"]["value"] for f in body["query"]["filterBy"]}
+        offset, direction = filters["startRank"], filters["direction"]
+        size = body["resultsLimit"] // 2
+        if direction == "DESCENDING":
+            ranks = range(offset, max(offset - size, -1), -1)
+        else:
+            ranks = range(offset, min(offset + size, len(self.library.assets)))
+        records = []
+        for rank in ranks:
+            if not 0 <= rank < len(self.library.assets):
+                continue
+            asset = self.library.assets[rank]
+            records.append({
+                "recordType": "CPLAsset",
+                "recordName": "rel-" + asset["id"],
+                "fields": {
+                    "masterRef": {"value": {"recordName": asset["id"]}},
+                    "addedDate": {"value": asset["added"]},
+                    "assetDate": {"value": asset["added"]},
+                },
+            })
+            records.append({
+                "recordType": "CPLMaster",
+                "recordName": asset["id"],
+                "fields": {
+                    "filenameEnc": {"value": base64.b64encode(asset["filename"].encode()).decode()},
+                    "resOriginalRes": {"value": {"size": 4, "downloadURL": "https://fake/" + asset["id"]}},
+                },
+            })
+        return records
+
+    def get(self, url, stream=False):
+        asset_id = url.rsplit("/", 1)[1]
+        if asset_id in self.library.broken:
+            raise IOError("téléchargement impossible")
+        return FakeResponse(content=b"data")
+
+
+class FakeService:
+    """Remplace PyiCloudService : même cache du service Photos, authentification simulée."""
+
+    def __init__(self, library):
+        self.session = FakeSession(library)
+        self.params = {"clientId": "test", "dsid": "1"}
+        self.requires_2fa = False
+        self.codes = []
+        self._photos = None
+
+    @property
+    def photos(self):
+        if not self._photos:
+            self._photos = PhotosService("https://fake.icloud.com", self.session, self.params)
+        return self._photos
+
+    def validate_2fa_code(self, code):
+        self.codes.append(code)
+        if code != "123456":
+            return False
+        self.requires_2fa = False
+        return True
+
+
+@pytest.fixture
+def scheduler(tmp_path, monkeypatch):
+    jobs_dir = tmp_path / "sync_jobs"
+    jobs_dir.mkdir()
+    monkeypatch.setattr(logic, "SYNC_JOBS_DIR", str(jobs_dir))
+    monkeypatch.setattr(logic, "LOGIN_ATTEMPTS", logic.defaultdict(list))
+    return logic.SyncScheduler()
+
+
+@pytest.fixture
+def destination(tmp_path):
+    path = tmp_path / "photos"
+    path.mkdir()
+    return str(path)
+
+
+def make_job(scheduler, destination, library, limit=None):
+    job = scheduler.schedule("user@example.com", "Passw0rd1", destination, 3600, limit=limit)
+    job.api = FakeService(library)
+    return job
+
+
+def synced_files(destination):
+    with open(os.path.join(destination, "imported_files.log"), encoding="utf-8") as f:
+        return [os.path.basename(line.strip()) for line in f]
+
+
+def test_first_run_writes_library_to_destination(scheduler, destination):
+    library = FakeLibrary(3)
+    job = make_job(scheduler, destination, library)
+
+    logic.run_sync_job(job.job_id, scheduler)
+
+    assert job.status == "idle"
+    assert sorted(synced_files(destination)) == ["IMG_0001.JPG", "IMG_0002.JPG", "IMG_0003.JPG"]
+    assert os.path.exists(os.path.join(destination, "2026", "01", "IMG_0003.JPG"))
+    assert job.synced_count == 3
+
+
+def test_unchanged_library_costs_one_request(scheduler, destination):
+    library = FakeLibrary(3)
+    job = make_job(scheduler, destination, library)
+    logic.run_sync_job(job.job_id, scheduler)
+    session = job.api.session
+    session.posts.clear()
+
+    logic.run_sync_job(job.job_id, scheduler)
+
+    assert session.posts == ["CheckIndexingState"]
+    assert job.status == "idle"
+
+
+def test_new_photo_is_synced_without_listing_whole_library(scheduler, destination, monkeypatch):
+    library = FakeLibrary(250)
+    job = make_job(scheduler, destination, library)
+    logic.run_sync_job(job.job_id, scheduler)
+    session = job.api.session
+    session.posts.clear()
+
+    library.add()
+    logic.run_sync_job(job.job_id, scheduler)
+
+    # Jeton, nombre d'assets, puis une seule page du parcours descendant
+    assert session.posts == ["CheckIndexingState", "HyperionIndexCountLookup", "CPLAssetAndMasterByAddedDate"]
+    assert synced_files(destination)[-1] == "IMG_0251.JPG"
+    assert job.library_count == 251
+
+
+def test_add_and_delete_with_same_count_is_detected(scheduler, destination):
+    library = FakeLibrary(3)
+    job = make_job(scheduler, destination, library)
+    logic.run_sync_job(job.job_id, scheduler)
+
+    library.delete(0)
+    library.add()
+    logic.run_sync_job(job.job_id, scheduler)
+
+    assert job.library_count == 3
+    assert "IMG_0004.JPG" in synced_files(destination)
+
+
+def test_assets_added_behind_cursor_trigger_full_rescan(scheduler, destination):
+    library = FakeLibrary(3)
+    job = make_job(scheduler, destination, library)
+    logic.run_sync_job(job.job_id, scheduler)
+
+    # Asset ajouté avec une date antérieure au curseur : invisible au parcours incrémental
+    library.add()
+    late = library.assets.pop()
+    late["added"] = library.assets[0]["added"] - 1
+    library.assets.insert(0, late)
+    logic.run_sync_job(job.job_id, scheduler)
+    assert job.sync_token is None
+
+    logic.run_sync_job(job.job_id, scheduler)
+    assert "IMG_0004.JPG" in synced_files(destination)
+
+
+def test_failed_asset_is_retried_up_to_limit(scheduler, destination):
+    library = FakeLibrary(3)
+    library.broken.add("asset-2")
+    job = make_job(scheduler, destination, library)
+
+    for _ in range(logic.MAX_SYNC_RETRIES):
+        logic.run_sync_job(job.job_id, scheduler)
+        assert job.status == "error"
+        assert len(job.errors) == 1
+
+    assert job.failed_assets == {"asset-2": logic.MAX_SYNC_RETRIES}
+    session = job.api.session
+    session.posts.clear()
+    logic.run_sync_job(job.job_id, scheduler)
+    assert session.posts == ["CheckIndexingState"]
+    assert job.status == "idle"
+    assert job.errors == []
+
+
+def test_run_is_truncated_at_batch_limit(scheduler, destination, monkeypatch):
+    monkeypatch.setattr(logic, "SYNC_BATCH_LIMIT", 2)
+    library = FakeLibrary(5)
+    job = make_job(scheduler, destination, library)
+
+    logic.run_sync_job(job.job_id, scheduler)
+    assert job.synced_count == 2
+    assert job.sync_token is None
+
+    logic.run_sync_job(job.job_id, scheduler)
+    logic.run_sync_job(job.job_id, scheduler)
+    assert job.synced_count == 5
+    assert job.sync_token == f"token-{library.version}"
+
+
+def test_limit_caps_total_synced_files(scheduler, destination):
+    library = FakeLibrary(5)
+    job = make_job(scheduler, destination, library, limit=2)
+
+    logic.run_sync_job(job.job_id, scheduler)
+    library.add()
+    logic.run_sync_job(job.job_id, scheduler)
+
+    assert job.synced_count == 2
+    assert job.status == "finished"
+    assert scheduler.status(job.job_id)["next_run"] is None
+
+
+def test_refused_login_blocks_job(scheduler, destination, monkeypatch):
+    def refuse(email, password):
+        raise PyiCloudFailedLoginException("Invalid email/password combination.")
+
+    monkeypatch.setattr(logic, "PyiCloudService", refuse)
+    job = scheduler.schedule("user@example.com", "Passw0rd1", destination, 3600)
+
+    logic.run_sync_job(job.job_id, scheduler)
+
+    assert job.status == "auth_required"
+    assert job.password is None
+    assert job.status in logic.SYNC_BLOCKED_STATUSES
+
+
+def test_two_factor_flow(scheduler, destination):
+    library = FakeLibrary(2)
+    job = make_job(scheduler, destination, library)
+    api = job.api
+    api.requires_2fa = True
+
+    logic.run_sync_job(job.job_id, scheduler)
+    assert job.status == "2fa_required"
+    assert job.api is api
+
+    assert scheduler.validate_2fa(job.job_id, "000000") is False
+    assert job.status == "2fa_required"
+    assert scheduler.validate_2fa(job.job_id, "123456") is True
+    assert job.status == "scheduled"
+    assert scheduler.validate_2fa("missing", "123456") is None
+
+    logic.run_sync_job(job.job_id, scheduler)
+    assert job.synced_count == 2
+
+
+def test_reschedule_is_rejected_while_running(scheduler, destination):
+    job = scheduler.schedule("user@example.com", "Passw0rd1", destination, 3600)
+    job.running = True
+
+    with pytest.raises(ValueError):
+        scheduler.schedule("user@example.com", "Passw0rd1", destination, 7200)
+    assert job.interval == 3600
+
+
+def test_loaded_jobs_wait_for_password(scheduler, destination):
+    job = scheduler.schedule("user@example.com", "Passw0rd1", destination, 3600)
+
+    reloaded = logic.SyncScheduler()
+
+    assert reloaded.status(job.job_id)["status"] == "auth_required"
+    assert reloaded.status("missing") is None
+
+
+def test_jitter_bounds():
+    for _ in range(200):
+        assert 0 <= logic.sync_jitter(3600) <= 360
+        assert 0 <= logic.sync_jitter(logic.MAX_SYNC_INTERVAL) <= logic.MAX_SYNC_JITTER